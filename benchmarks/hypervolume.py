@@ -0,0 +1,51 @@
+"""Measures how `kurobako.metrics.hypervolume` scales with the number of points and objectives.
+
+Points are sampled on the unit sphere, so that (almost) all of them are non-dominated, which is
+the worst case for every algorithm.
+
+Usage: python benchmarks/hypervolume.py [--seed N]
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from kurobako.metrics import hypervolume
+
+# The numbers of points to measure, per number of objectives.
+SIZES = {
+    2: [1000, 10000, 100000],
+    3: [1000, 10000, 100000],
+    4: [100, 300, 1000],
+    5: [50, 100, 200],
+    6: [20, 40, 80],
+}
+
+
+def sample_front(rng: np.random.RandomState, n_points: int, n_objectives: int) -> np.ndarray:
+    points = np.abs(rng.normal(size=(n_points, n_objectives)))
+    return 1.0 - points / np.linalg.norm(points, axis=1, keepdims=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    for n_objectives, sizes in SIZES.items():
+        for n_points in sizes:
+            points = sample_front(rng, n_points, n_objectives)
+            start = time.perf_counter()
+            volume = hypervolume(points, [1.1] * n_objectives)
+            elapsed = time.perf_counter() - start
+            print(
+                "objectives={} points={:<7} time={:9.4f}s hypervolume={:.6f}".format(
+                    n_objectives, n_points, elapsed, volume
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Measures the startup time of a solver process.
+
+Kurobako spawns a fresh solver process for every run, so the time spent to import modules and to
+build the solver specification is paid again and again. Each snippet below is run in a fresh
+interpreter and the median wall-clock time is reported.
+
+Usage: python benchmarks/startup.py [--repeat N]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+SNIPPETS = [
+    ("python", "pass"),
+    ("import kurobako.solver", "import kurobako.solver"),
+    ("import kurobako.solver.optuna", "import kurobako.solver.optuna"),
+    (
+        "OptunaSolverFactory.specification()",
+        "from kurobako.solver.optuna import OptunaSolverFactory\n"
+        "OptunaSolverFactory(None).specification()",
+    ),
+]
+
+
+def measure(code: str, repeat: int) -> float:
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        elapsed.append(time.perf_counter() - start)
+    return statistics.median(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    for name, code in SNIPPETS:
+        print("{:<40} {:8.1f} ms".format(name, measure(code, args.repeat) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""A columnar record of the ask, tell and evaluate events handled by runners.
+
+An `EventSink` appends events to a directory of column files. Every column is a raw
+little-endian array, so `load_events` can memory-map a whole campaign without parsing it:
+
+- ``kind.u1``: `ASK`, `TELL` or `EVALUATE`.
+- ``owner_id.i8``: the solver id (ask and tell) or the problem id (evaluate).
+- ``trial_id.i8``: the trial id (ask and tell) or the evaluator id (evaluate).
+- ``step.i8``: the next step (ask), or the current step (tell and evaluate). ``-1`` if unknown.
+- ``start.f8``: the UNIX time at which the solver or the evaluator was called.
+- ``elapsed.f8``: the seconds spent in the solver or the evaluator.
+- ``params.f8`` and ``params_len.i8``: the flattened parameters (``NaN`` for inactive ones) and
+  the number of parameters of each event. Tell events have no parameters.
+- ``values.f8`` and ``values_len.i8``: the same for values. Ask events have no values.
+
+Events are buffered in memory and written in batches by a background thread. A sink must not be
+shared by several processes, so `SolverRunner.serve` and `ProblemRunner.serve` (which fork a
+process per session) reject runners that have one.
+"""
+
+import atexit
+import os
+import threading
+from typing import Any  # NOQA
+from typing import Dict
+from typing import List  # NOQA
+from typing import Optional
+from typing import Sequence
+from typing import Tuple  # NOQA
+
+import numpy as np
+
+from kurobako.solver import EvaluatedTrial
+from kurobako.solver import NextTrial
+
+ASK = 0
+TELL = 1
+EVALUATE = 2
+
+_COLUMNS = [
+    ("kind", "u1"),
+    ("owner_id", "<i8"),
+    ("trial_id", "<i8"),
+    ("step", "<i8"),
+    ("start", "<f8"),
+    ("elapsed", "<f8"),
+]
+
+_Event = Tuple[int, int, int, int, float, float, Sequence[Optional[float]], Sequence[float]]
+
+
+def _column_path(path: str, name: str, dtype: str) -> str:
+    return os.path.join(path, "{}.{}".format(name, dtype.lstrip("<")))
+
+
+class EventSink(object):
+    def __init__(self, path: str, flush_interval: float = 1.0, batch_size: int = 65536):
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._events = []  # type: List[_Event]
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._error = None  # type: Optional[Exception]
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record_ask(self, solver_id: int, trial: NextTrial, start: float, elapsed: float):
+        step = -1 if trial.next_step is None else trial.next_step
+        self._record((ASK, solver_id, trial.trial_id, step, start, elapsed, trial.params, ()))
+
+    def record_tell(self, solver_id: int, trial: EvaluatedTrial, start: float, elapsed: float):
+        step = trial.current_step
+        self._record((TELL, solver_id, trial.trial_id, step, start, elapsed, (), trial.values))
+
+    def record_evaluate(
+        self,
+        problem_id: int,
+        evaluator_id: int,
+        params: Sequence[Optional[float]],
+        current_step: Optional[int],
+        values: Sequence[float],
+        start: float,
+        elapsed: float,
+    ):
+        step = -1 if current_step is None else current_step
+        self._record((EVALUATE, problem_id, evaluator_id, step, start, elapsed, params, values))
+
+    def _record(self, event: _Event):
+        with self._lock:
+            self._events.append(event)
+            if len(self._events) >= self._batch_size:
+                self._wakeup.set()
+
+    def flush(self):
+        """Writes all the recorded events."""
+
+        self._write()
+
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._wakeup.set()
+            self._thread.join()
+            atexit.unregister(self.close)
+        self.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+
+            try:
+                self._write()
+            except Exception as e:
+                self._error = e
+
+    def _write(self):
+        # Holding `_write_lock` while taking the events keeps the batches in order.
+        with self._write_lock:
+            with self._lock:
+                events = self._events
+                self._events = []
+            if len(events) == 0:
+                return
+
+            params = [p for e in events for p in e[6]]
+            values = [v for e in events for v in e[7]]
+            params_len = [len(e[6]) for e in events]
+            values_len = [len(e[7]) for e in events]
+
+            # The variable-length columns go first, so that a partially written batch never has
+            # rows that point beyond them.
+            self._append("params", "<f8", [np.nan if p is None else p for p in params])
+            self._append("values", "<f8", values)
+            self._append("params_len", "<i8", params_len)
+            self._append("values_len", "<i8", values_len)
+            for i, (name, dtype) in enumerate(_COLUMNS):
+                self._append(name, dtype, [e[i] for e in events])
+
+    def _append(self, name: str, dtype: str, column: Sequence[Any]):
+        with open(_column_path(self._path, name, dtype), "ab") as f:
+            f.write(np.asarray(column, dtype=dtype).tobytes())
+
+
+def _memmap(path: str, name: str, dtype: str) -> np.ndarray:
+    filename = _column_path(path, name, dtype)
+    if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode="r")
+
+
+def load_events(path: str) -> Dict[str, np.ndarray]:
+    """Memory-maps the events written by an `EventSink`.
+
+    The returned dictionary has the fixed-size columns described in the module documentation, and
+    ``params``/``values`` with ``params_offsets``/``values_offsets``: the parameters of the i-th
+    event are ``params[params_offsets[i]:params_offsets[i + 1]]``.
+    """
+
+    columns = {name: _memmap(path, name, dtype) for name, dtype in _COLUMNS}
+    lengths = {name: _memmap(path, name + "_len", "<i8") for name in ("params", "values")}
+    n_events = min(len(c) for c in list(columns.values()) + list(lengths.values()))
+
+    events = {name: column[:n_events] for name, column in columns.items()}
+    for name, length in lengths.items():
+        offsets = np.zeros(n_events + 1, dtype=np.int64)
+        np.cumsum(length[:n_events], out=offsets[1:])
+        events[name + "_offsets"] = offsets
+        events[name] = _memmap(path, name, "<f8")[: offsets[-1]]
+    return events
@@ -0,0 +1,147 @@
+"""Binary framing of solver and problem messages.
+
+Runners speak line-delimited JSON by default, which is what the kurobako binary understands. For
+peers that are themselves kurobako-py (e.g., in-process tooling, replay tools or a local server),
+converting long float lists to text and back dominates the cost of a message. Such peers can
+switch a runner to binary framing.
+
+This module only provides the runner side of the protocol and the functions a peer needs to
+speak it. The kurobako binary never sends ``SET_FRAMING_MESSAGE``, so runners driven by it always
+use JSON. The protocol is:
+
+1. A runner created with ``binary_framing=True`` adds ``FRAMING_ATTR: "binary"`` to the attributes
+   of the specification it casts first.
+2. If the peer finds the attribute, it may send ``SET_FRAMING_MESSAGE`` as a JSON line.
+3. From then on, both directions use the frames written by `write_message`.
+
+A frame consists of a little-endian ``uint32`` header length, a little-endian ``uint32`` number of
+floats, the header and the floats. The header is the JSON encoded message, in which the float
+arrays listed in ``_ARRAY_FIELDS`` are replaced by ``{"offset": i, "len": n}`` (empty arrays are
+left in the header). The floats are stored as raw little-endian float64 values and decoded as
+NumPy arrays without copying. The runners still convert them to lists before passing them to
+solvers and problems, whose interfaces take lists, so the saving is in formatting and parsing
+text rather than in copies.
+"""
+
+import array
+import json
+import struct
+import sys
+from typing import Any
+from typing import BinaryIO
+from typing import Dict
+from typing import List  # NOQA
+from typing import Optional
+from typing import Tuple  # NOQA
+
+FRAMING_ATTR = "kurobako-py.framing"
+SET_FRAMING_MESSAGE = {"type": "SET_FRAMING_CAST", "framing": "binary"}
+
+_PREFIX = struct.Struct("<II")
+
+# The float arrays that are carried out of the JSON header, by message type.
+_ARRAY_FIELDS = {
+    "ASK_REPLY": [("trial", "params")],
+    "TELL_CALL": [("trial", "values")],
+    "CREATE_EVALUATOR_CALL": [("params",)],
+    "EVALUATE_REPLY": [("values",)],
+}  # type: Dict[str, List[Tuple[str, ...]]]
+
+
+def _is_float_array(value: Any) -> bool:
+    if isinstance(value, list):
+        # Lists that contain `None` (i.e., inactive parameters) are left in the header.
+        return all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value)
+
+    return hasattr(value, "dtype") and hasattr(value, "ndim") and value.ndim == 1
+
+
+def _to_bytes(value: Any) -> bytes:
+    if isinstance(value, list):
+        floats = array.array("d", value)
+        if sys.byteorder != "little":
+            floats.byteswap()
+        return floats.tobytes()
+
+    return value.astype("<f8", copy=False).tobytes()
+
+
+def encode(message: Dict[str, Any]) -> bytes:
+    """Encodes a message into a frame."""
+
+    header = dict(message)
+    chunks = []  # type: List[bytes]
+    n_floats = 0
+    for path in _ARRAY_FIELDS.get(message["type"], []):
+        parent = header
+        for key in path[:-1]:
+            parent[key] = dict(parent[key])
+            parent = parent[key]
+
+        value = parent[path[-1]]
+        if len(value) == 0 or not _is_float_array(value):
+            continue
+
+        parent[path[-1]] = {"offset": n_floats, "len": len(value)}
+        chunks.append(_to_bytes(value))
+        n_floats += len(value)
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    # Pads the header with whitespace so that the floats are 8-byte aligned.
+    header_bytes += b" " * (-len(header_bytes) % 8)
+    return b"".join([_PREFIX.pack(len(header_bytes), n_floats), header_bytes] + chunks)
+
+
+def write_message(stream: BinaryIO, message: Dict[str, Any]):
+    stream.write(encode(message))
+    stream.flush()
+
+
+def _read_exact(stream: BinaryIO, n: int) -> Optional[bytearray]:
+    buf = bytearray(n)
+    view = memoryview(buf)
+    pos = 0
+    while pos < n:
+        k = stream.readinto(view[pos:])  # type: ignore
+        if not k:
+            return None
+        pos += k
+    return buf
+
+
+def read_message(stream: BinaryIO) -> Optional[Dict[str, Any]]:
+    """Reads a frame and decodes it into a message.
+
+    ``None`` is returned if the stream reached EOF. The float arrays are writable NumPy arrays that
+    share the memory of the frame.
+    """
+
+    prefix = _read_exact(stream, _PREFIX.size)
+    if prefix is None:
+        return None
+    header_len, n_floats = _PREFIX.unpack(prefix)
+
+    body = _read_exact(stream, header_len + n_floats * 8)
+    if body is None:
+        return None
+
+    message = json.loads(bytes(body[:header_len]))
+    fields = _ARRAY_FIELDS.get(message["type"], [])
+    if len(fields) == 0:
+        return message
+
+    import numpy as np
+
+    floats = np.frombuffer(body, dtype="<f8", count=n_floats, offset=header_len)
+    for path in fields:
+        parent = message
+        for key in path[:-1]:
+            parent = parent[key]
+
+        value = parent[path[-1]]
+        if isinstance(value, dict):
+            start = value["offset"]
+            end = start + value["len"]
+            parent[path[-1]] = floats[start:end]
+
+    return message
@@ -0,0 +1,165 @@
+import bisect
+import enum
+from typing import List  # NOQA
+from typing import Optional
+from typing import Sequence
+
+import numpy as np
+
+
+class Direction(enum.Enum):
+    MINIMIZE = 0
+    MAXIMIZE = 1
+
+
+def hypervolume(
+    points: np.ndarray,
+    reference_point: Sequence[float],
+    directions: Optional[Sequence[Direction]] = None,
+) -> float:
+    """Computes the exact hypervolume dominated by ``points`` and bounded by ``reference_point``.
+
+    ``points`` is an array of shape ``(n_points, n_objectives)``, such as the values of trials
+    evaluated against a problem whose `ProblemSpec.reference_point` is ``reference_point``. All
+    objectives are minimized (as kurobako does) unless ``directions`` says otherwise. Points that
+    do not strictly dominate the reference point do not contribute to the hypervolume.
+
+    Two objectives are handled by a sweep in O(n log n), three objectives by a dimension sweep
+    over a sorted two-dimensional front, and four or more objectives by the WFG algorithm.
+    """
+
+    points = np.asarray(points, dtype=float)
+    reference = np.asarray(reference_point, dtype=float)
+    if points.ndim != 2 or reference.shape != (points.shape[1],):
+        raise ValueError(
+            "Expected points of shape (n, {}), but got {}.".format(len(reference), points.shape)
+        )
+
+    if directions is not None:
+        if len(directions) != len(reference):
+            raise ValueError("The number of directions must equal the number of objectives.")
+        signs = np.array([-1.0 if d == Direction.MAXIMIZE else 1.0 for d in directions])
+        points = points * signs
+        reference = reference * signs
+
+    return _hypervolume(points[np.all(points < reference, axis=1)], reference)
+
+
+def _pareto_front(points: np.ndarray) -> np.ndarray:
+    # Returns the non-dominated points in lexicographic order, with duplicates removed.
+    if len(points) <= 1:
+        return points
+
+    points = points[np.lexsort(points.T[::-1])]
+    unique = np.ones(len(points), dtype=bool)
+    unique[1:] = np.any(points[1:] != points[:-1], axis=1)
+    points = points[unique]
+
+    dominated = np.zeros(len(points), dtype=bool)
+    for i in range(len(points)):
+        if dominated[i]:
+            continue
+
+        # Only the points that come later in lexicographic order can be dominated by `points[i]`.
+        start = i + 1
+        dominated[start:] |= np.all(points[i] <= points[start:], axis=1)
+    return points[~dominated]
+
+
+def _hypervolume(points: np.ndarray, reference: np.ndarray) -> float:
+    # All of `points` must strictly dominate `reference`.
+    if len(points) == 0:
+        return 0.0
+    elif len(points) == 1:
+        return float(np.prod(reference - points[0]))
+    elif len(points) == 2:
+        overlap = np.prod(reference - np.maximum(points[0], points[1]))
+        return float(np.sum(np.prod(reference - points, axis=1)) - overlap)
+
+    n_objectives = points.shape[1]
+    if n_objectives == 1:
+        return float(reference[0] - points[:, 0].min())
+    elif n_objectives == 2:
+        return _hypervolume2d(points, reference)
+    elif n_objectives == 3:
+        return _hypervolume3d(points, reference)
+    else:
+        return _hypervolume_wfg(points, reference)
+
+
+def _hypervolume2d(points: np.ndarray, reference: np.ndarray) -> float:
+    points = points[np.lexsort((points[:, 1], points[:, 0]))]
+
+    volume = 0.0
+    prev_y = reference[1]
+    for x, y in points.tolist():
+        if y < prev_y:
+            volume += (reference[0] - x) * (prev_y - y)
+            prev_y = y
+    return volume
+
+
+def _hypervolume3d(points: np.ndarray, reference: np.ndarray) -> float:
+    points = points[np.argsort(points[:, 2], kind="stable")]
+    ref_x, ref_y, ref_z = reference.tolist()
+
+    # The two-dimensional front of the points swept so far, sorted by ascending `x` (so `y` is
+    # strictly descending), and the area it dominates.
+    xs = []  # type: List[float]
+    ys = []  # type: List[float]
+    area = 0.0
+
+    volume = 0.0
+    prev_z = None  # type: Optional[float]
+    for x, y, z in points.tolist():
+        if prev_z is not None:
+            volume += area * (z - prev_z)
+        prev_z = z
+
+        i = bisect.bisect_left(xs, x)
+        if i > 0 and ys[i - 1] <= y:
+            continue
+        if i < len(xs) and xs[i] == x and ys[i] <= y:
+            continue
+
+        # Adds the area that only (x, y) dominates, while removing the points it dominates.
+        ceiling_x = x
+        ceiling_y = ys[i - 1] if i > 0 else ref_y
+        j = i
+        while j < len(xs) and ys[j] >= y:
+            area += (xs[j] - ceiling_x) * (ceiling_y - y)
+            ceiling_x = xs[j]
+            ceiling_y = ys[j]
+            j += 1
+        end_x = xs[j] if j < len(xs) else ref_x
+        area += (end_x - ceiling_x) * (ceiling_y - y)
+
+        xs[i:j] = [x]
+        ys[i:j] = [y]
+
+    assert prev_z is not None
+    return volume + area * (ref_z - prev_z)
+
+
+def _hypervolume_wfg(points: np.ndarray, reference: np.ndarray) -> float:
+    # WFG: the hypervolume is the sum of the exclusive contribution of each point with respect to
+    # the points that follow it. Sorting by the last objective keeps the limited sets small.
+    points = _pareto_front(points)
+    points = points[np.argsort(points[:, -1], kind="stable")]
+
+    volume = 0.0
+    for i in range(len(points)):
+        start = i + 1
+        volume += _exclusive_hypervolume(points[i], points[start:], reference)
+    return volume
+
+
+def _exclusive_hypervolume(point: np.ndarray, others: np.ndarray, reference: np.ndarray) -> float:
+    # The hypervolume dominated by `point` but not by any of `others`.
+    inclusive = float(np.prod(reference - point))
+    if len(others) == 0:
+        return inclusive
+
+    limited = np.maximum(others, point)
+    limited = limited[np.all(limited < reference, axis=1)]
+    return inclusive - _hypervolume(limited, reference)
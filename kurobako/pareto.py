@@ -0,0 +1,332 @@
+import bisect
+from typing import Any
+from typing import Dict  # NOQA
+from typing import List  # NOQA
+from typing import Optional
+from typing import Sequence
+from typing import Union
+
+import numpy as np
+
+from kurobako.metrics import _hypervolume
+from kurobako.problem import ProblemSpec
+from kurobako.solver import EvaluatedTrial
+
+_INITIAL_CAPACITY = 64
+_CHUNK_SIZE = 256
+_N_WITNESSES = 16
+
+
+class ParetoArchive(object):
+    """An archive of the non-dominated values told to a multi-objective solver.
+
+    Values are minimized, as in kurobako. Each insertion or removal costs a vectorized dominance
+    check against the archive, instead of a rescan of all the trials of a study.
+
+    If ``epsilon`` is given, the archive keeps at most one point per epsilon box (i.e.,
+    epsilon-dominance), which bounds its size regardless of the number of trials.
+
+    If ``reference_point`` is given, the archive also maintains its hypervolume and the
+    hypervolume contribution of each point (the volume dominated only by that point). With two
+    objectives, the points are kept sorted along the front, so an insertion or a removal only
+    updates its two neighbours: O(log n) to locate them, plus a shift of the sorted list. With
+    more objectives, the contributions of the points whose exclusive regions overlap the inserted
+    or removed point are recomputed by hypervolume computations over the archive, so the cost of
+    an update grows with the size of the front.
+    """
+
+    def __init__(
+        self,
+        n_objectives: int,
+        reference_point: Optional[Sequence[float]] = None,
+        epsilon: Optional[Union[float, Sequence[float]]] = None,
+        last_step: Optional[int] = None,
+    ):
+        self._n_objectives = n_objectives
+        self._last_step = last_step
+
+        if reference_point is None:
+            self._reference = None  # type: Optional[np.ndarray]
+        else:
+            self._reference = np.asarray(reference_point, dtype=float)
+            if self._reference.shape != (n_objectives,):
+                raise ValueError("The reference point must have {} values.".format(n_objectives))
+
+        if epsilon is None:
+            self._epsilon = None  # type: Optional[np.ndarray]
+        else:
+            self._epsilon = np.broadcast_to(np.asarray(epsilon, dtype=float), (n_objectives,))
+            if np.any(self._epsilon <= 0):
+                raise ValueError("Epsilon must be positive, but got {}.".format(epsilon))
+
+        self._values = np.empty((_INITIAL_CAPACITY, n_objectives))
+        self._trial_ids = np.empty(_INITIAL_CAPACITY, dtype=np.int64)
+        self._contributions = np.zeros(_INITIAL_CAPACITY)
+        self._rows = {}  # type: Dict[int, int]
+        self._size = 0
+        self._hypervolume = 0.0
+
+        # With two objectives, the points that dominate the reference point sorted by the first
+        # objective (and hence in descending order of the second one).
+        self._sorted_xs = []  # type: List[float]
+        self._sorted_ids = []  # type: List[int]
+
+    @staticmethod
+    def from_spec(
+        spec: ProblemSpec, epsilon: Optional[Union[float, Sequence[float]]] = None
+    ) -> Any:
+        """Creates an archive for the values and the reference point of the given problem.
+
+        `tell` of the returned archive ignores evaluations at intermediate steps.
+        """
+
+        return ParetoArchive(
+            len(spec.values),
+            reference_point=spec.reference_point,
+            epsilon=epsilon,
+            last_step=spec.last_step,
+        )
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, trial_id: int) -> bool:
+        return trial_id in self._rows
+
+    @property
+    def trial_ids(self) -> np.ndarray:
+        return self._trial_ids[: self._size]
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._values[: self._size]
+
+    @property
+    def contributions(self) -> np.ndarray:
+        """The hypervolume contribution of each point, in the same order as `values`."""
+
+        self._check_reference_point()
+        return self._contributions[: self._size]
+
+    @property
+    def hypervolume(self) -> float:
+        self._check_reference_point()
+        return self._hypervolume
+
+    def tell(self, trial: EvaluatedTrial) -> bool:
+        """Adds an evaluated trial, as told to `Solver.tell`.
+
+        Unevaluable trials and, if the last step is known, intermediate evaluations are ignored.
+        """
+
+        if len(trial.values) == 0:
+            return False
+        if self._last_step is not None and trial.current_step != self._last_step:
+            return False
+        return self.add(trial.trial_id, trial.values)
+
+    def add(self, trial_id: int, values: Sequence[float]) -> bool:
+        """Adds a point, and returns whether it was kept in the archive.
+
+        Points that the point dominates (or that it replaces in its epsilon box) are removed.
+        """
+
+        if trial_id in self._rows:
+            raise ValueError("Trial {} is already in the archive.".format(trial_id))
+
+        point = np.asarray(values, dtype=float)
+        if point.shape != (self._n_objectives,):
+            raise ValueError("Expected {} values, but got {}.".format(self._n_objectives, values))
+
+        archived = self.values
+        if self._epsilon is None:
+            if np.any(np.all(archived <= point, axis=1)):
+                return False
+            evicted = np.flatnonzero(np.all(point <= archived, axis=1))
+        else:
+            boxes = np.floor(archived / self._epsilon)
+            box = np.floor(point / self._epsilon)
+            same_box = np.all(boxes == box, axis=1)
+            if np.any(np.all(boxes <= box, axis=1) & ~same_box):
+                return False
+
+            evicted = np.all(box <= boxes, axis=1) & ~same_box
+            for i in np.flatnonzero(same_box):
+                # Within a box, a dominating point wins. Otherwise, the point closer to the
+                # lower corner of the box wins.
+                other = archived[i]
+                corner = box * self._epsilon
+                if np.all(other <= point) or (
+                    not np.all(point <= other)
+                    and np.linalg.norm(other - corner) <= np.linalg.norm(point - corner)
+                ):
+                    return False
+                evicted[i] = True
+            evicted = np.flatnonzero(evicted)
+
+        dominated = evicted[np.all(point <= archived[evicted], axis=1)]
+        dominated_ids = self._trial_ids[dominated].tolist()
+        other_ids = self._trial_ids[np.setdiff1d(evicted, dominated)].tolist()
+
+        if self._n_objectives == 2:
+            # Removing the evicted points first keeps the sorted front free of dominated points.
+            for evicted_id in dominated_ids + other_ids:
+                self._delete(evicted_id, update_contributions=True)
+            self._insert(trial_id, point, dominated[:0])
+            return True
+
+        self._insert(trial_id, point, dominated)
+
+        # A dominated point no longer contributes to the hypervolume, and neither does the region
+        # it shares with other points, so it can be dropped without any update.
+        for evicted_id in dominated_ids:
+            self._delete(evicted_id, update_contributions=False)
+        for evicted_id in other_ids:
+            self._delete(evicted_id, update_contributions=True)
+        return True
+
+    def remove(self, trial_id: int) -> bool:
+        """Removes a point, and returns whether it was in the archive."""
+
+        if trial_id not in self._rows:
+            return False
+
+        self._delete(trial_id, update_contributions=True)
+        return True
+
+    def _check_reference_point(self):
+        if self._reference is None:
+            raise ValueError("The archive has no reference point.")
+
+    def _insert(self, trial_id: int, point: np.ndarray, dominated: np.ndarray):
+        if self._size == len(self._values):
+            capacity = 2 * len(self._values)
+            self._values = np.resize(self._values, (capacity, self._n_objectives))
+            self._trial_ids = np.resize(self._trial_ids, capacity)
+            self._contributions = np.resize(self._contributions, capacity)
+
+        row = self._size
+        self._values[row] = point
+        self._trial_ids[row] = trial_id
+        self._contributions[row] = 0.0
+        self._rows[trial_id] = row
+        self._size += 1
+
+        if self._reference is None or not np.all(point < self._reference):
+            return
+
+        if self._n_objectives == 2:
+            i = bisect.bisect_left(self._sorted_xs, point[0])
+            self._sorted_xs.insert(i, float(point[0]))
+            self._sorted_ids.insert(i, trial_id)
+            self._hypervolume += self._update_contribution2d(i)
+            self._update_contribution2d(i - 1)
+            self._update_contribution2d(i + 1)
+            return
+
+        others = np.arange(row)
+        self._hypervolume += self._exclusive_hypervolume(point, others)
+        self._contributions[:row] -= self._shared_hypervolumes(point, others)
+
+        # The regions of the dominated points become exclusive to `point` once they are gone.
+        others = np.setdiff1d(others, dominated)
+        self._contributions[row] = self._exclusive_hypervolume(point, others)
+
+    def _delete(self, trial_id: int, update_contributions: bool):
+        row = self._rows.pop(trial_id)
+        point = self._values[row].copy()
+        contribution = self._contributions[row]
+
+        last = self._size - 1
+        if row != last:
+            self._values[row] = self._values[last]
+            self._trial_ids[row] = self._trial_ids[last]
+            self._contributions[row] = self._contributions[last]
+            self._rows[int(self._trial_ids[row])] = row
+        self._size -= 1
+
+        if self._reference is None or not np.all(point < self._reference):
+            return
+
+        self._hypervolume -= contribution
+        if self._n_objectives == 2:
+            i = bisect.bisect_left(self._sorted_xs, point[0])
+            del self._sorted_xs[i]
+            del self._sorted_ids[i]
+            self._update_contribution2d(i - 1)
+            self._update_contribution2d(i)
+        elif update_contributions:
+            others = np.arange(self._size)
+            self._contributions[: self._size] += self._shared_hypervolumes(point, others)
+
+    def _update_contribution2d(self, i: int) -> float:
+        # Recomputes the contribution of the i-th point of the sorted front from its neighbours.
+        assert self._reference is not None
+
+        if i < 0 or i >= len(self._sorted_ids):
+            return 0.0
+
+        row = self._rows[self._sorted_ids[i]]
+        x, y = self._values[row]
+        if i + 1 < len(self._sorted_xs):
+            right = self._sorted_xs[i + 1]
+        else:
+            right = self._reference[0]
+        if i > 0:
+            upper = self._values[self._rows[self._sorted_ids[i - 1]], 1]
+        else:
+            upper = self._reference[1]
+
+        contribution = float((right - x) * (upper - y))
+        self._contributions[row] = contribution
+        return contribution
+
+    def _exclusive_hypervolume(self, corner: np.ndarray, rows: np.ndarray) -> float:
+        # The volume dominated by `corner` but not by any of the points in `rows`.
+        assert self._reference is not None
+
+        inclusive = float(np.prod(self._reference - corner))
+        limited = np.maximum(self._values[rows], corner)
+        limited = limited[np.all(limited < self._reference, axis=1)]
+        return inclusive - _hypervolume(limited, self._reference)
+
+    def _shared_hypervolumes(self, point: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        # For each point `q` in `rows`, the volume dominated by both `point` and `q`, but by no
+        # other point in `rows`. This is how much the contribution of `q` shrinks when `point` is
+        # inserted, or grows when `point` is removed.
+        assert self._reference is not None
+
+        shared = np.zeros(len(rows))
+        if len(rows) == 0:
+            return shared
+
+        values = self._values[rows]
+        corners = np.maximum(values, point)
+        candidates = np.flatnonzero(np.all(corners < self._reference, axis=1))
+
+        # A corner that is dominated by a third point has no exclusive volume. The points closest
+        # to `point` rule out most of the corners, so they are tried first, and only the
+        # remaining corners are compared with every point.
+        closest = np.argsort(np.sum(corners - point, axis=1))[:_N_WITNESSES]
+        candidates = candidates[~self._is_dominated(corners, candidates, values, closest)]
+        everyone = np.arange(len(rows))
+        candidates = candidates[~self._is_dominated(corners, candidates, values, everyone)]
+
+        for i in candidates:
+            others = np.delete(rows, i)
+            shared[i] = self._exclusive_hypervolume(corners[i], others)
+        return shared
+
+    def _is_dominated(
+        self, corners: np.ndarray, candidates: np.ndarray, values: np.ndarray, by: np.ndarray
+    ) -> np.ndarray:
+        # Whether each of `corners[candidates]` is dominated by one of `values[by]`, excluding
+        # the point the corner belongs to. This is done in chunks to bound the memory.
+        dominated = np.zeros(len(candidates), dtype=bool)
+        for start in range(0, len(candidates), _CHUNK_SIZE):
+            end = start + _CHUNK_SIZE
+            chunk = candidates[start:end]
+            pairwise = np.all(values[None, by, :] <= corners[chunk, None, :], axis=2)
+            pairwise &= chunk[:, None] != by[None, :]
+            dominated[start:end] = np.any(pairwise, axis=1)
+        return dominated
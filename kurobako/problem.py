@@ -1,14 +1,31 @@
 import abc
 import copy
 import enum
+import hashlib
 import json
-import numpy as np
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import traceback
 from typing import Any
+from typing import BinaryIO
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Tuple  # NOQA
+from typing import TYPE_CHECKING
 from typing import Union
 
+from kurobako import framing
+from kurobako import threads
+
+if TYPE_CHECKING:
+    from kurobako.events import EventSink  # NOQA
+
 try:
     from lupa import LuaRuntime
 
@@ -19,6 +36,11 @@ except ImportError:
 
 Self = Any
 
+_logger = logging.getLogger(__name__)
+
+# The prefix of the specification attributes that runners add at runtime.
+_RUNTIME_ATTR_PREFIX = "kurobako-py."
+
 
 class Range(object, metaclass=abc.ABCMeta):
     @property
@@ -62,9 +84,9 @@ class ContinuousRange(Range):
 
     def to_dict(self) -> Dict[str, Any]:
         d = {"type": "CONTINUOUS"}  # type: Dict[str, Any]
-        if np.isfinite(self._low):
+        if math.isfinite(self._low):
             d["low"] = self._low
-        if np.isfinite(self._high):
+        if math.isfinite(self._high):
             d["high"] = self._high
         return d
 
@@ -243,6 +265,22 @@ class ProblemSpec(object):
             "reference_point": self.reference_point,
         }
 
+    def digest(self) -> str:
+        """Returns a stable hash of this specification.
+
+        Two specifications that serialize to the same dictionary have the same digest, so it can
+        be used to match results recorded for the same problem. The ``kurobako-py.*`` attributes
+        are ignored, because runners add them to describe runtime settings (e.g., the framing or
+        the thread governor) that may differ between processes serving the same problem.
+        """
+
+        d = self.to_dict()
+        d["attrs"] = {
+            k: v for k, v in d["attrs"].items() if not k.startswith(_RUNTIME_ATTR_PREFIX)
+        }
+        s = json.dumps(d, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
 
 class Evaluator(object):
     @abc.abstractmethod
@@ -252,12 +290,94 @@ class Evaluator(object):
     def current_step(self) -> int:
         raise NotImplementedError
 
+    def close(self):
+        # Called when the evaluator is dropped. Override this to release resources.
+        pass
+
+
+class _EvaluationTimeout(Exception):
+    def __init__(self, killed: bool):
+        # `killed` is `False` if the evaluation was refused because an earlier one timed out.
+        super().__init__()
+        self.killed = killed
+
+
+def _run_evaluator_worker(evaluator: Evaluator, conn: Any):
+    while True:
+        try:
+            next_step = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            values = evaluator.evaluate(next_step)
+            conn.send((list(values), evaluator.current_step(), None))
+        except Exception:
+            conn.send(([], 0, traceback.format_exc()))
+
+
+class _EvaluatorWorker(Evaluator):
+    """Runs an evaluator in a forked process, so that a runaway evaluation can be killed.
+
+    An evaluation that does not finish within ``timeout + timeout_per_step * (number of steps to
+    advance)`` seconds raises `_EvaluationTimeout`. The process is killed at that point, so any
+    later evaluation of this evaluator times out immediately. Workers are not reused across
+    evaluators: each one owns the state of a single evaluator.
+    """
+
+    def __init__(self, evaluator: Evaluator, timeout: float, timeout_per_step: float):
+        context = multiprocessing.get_context("fork")
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(
+            target=_run_evaluator_worker, args=(evaluator, child_conn), daemon=True
+        )
+        self._process.start()
+        child_conn.close()
+
+        self._timeout = timeout
+        self._timeout_per_step = timeout_per_step
+        self._current_step = 0
+        self._killed = False
+
+    def evaluate(self, next_step: int) -> List[float]:
+        if self._killed:
+            raise _EvaluationTimeout(killed=False)
+
+        timeout = self._timeout + self._timeout_per_step * max(0, next_step - self._current_step)
+        self._conn.send(next_step)
+        if not self._conn.poll(timeout):
+            self.close()
+            raise _EvaluationTimeout(killed=True)
+
+        values, self._current_step, error = self._conn.recv()
+        if error is not None:
+            raise RuntimeError("Evaluation failed in a worker process:\n{}".format(error))
+        return values
+
+    def current_step(self) -> int:
+        return self._current_step
+
+    def close(self):
+        if self._killed:
+            return
+
+        self._killed = True
+        self._conn.close()
+        if self._process.is_alive():
+            os.kill(self._process.pid, signal.SIGKILL)
+        self._process.join()
+
 
 class Problem(object):
     @abc.abstractmethod
     def create_evaluator(self, params: List[Optional[float]]) -> Optional[Evaluator]:
         raise NotImplementedError
 
+    def close(self):
+        # Called when the problem is dropped. Override this to release resources (e.g., the
+        # `kurobako.shared.SharedResource`s acquired by the problem).
+        pass
+
 
 class ProblemFactory(object):
     @abc.abstractmethod
@@ -270,16 +390,72 @@ class ProblemFactory(object):
 
 
 class ProblemRunner(object):
-    def __init__(self, factory: ProblemFactory):
+    """Runs the problems created by a factory, speaking kurobako's protocol on the stdio.
+
+    If ``evaluate_timeout`` or ``evaluate_timeout_per_step`` is given, every evaluator runs in a
+    process of its own, forked when the evaluator is created and exited when it is dropped. That
+    costs a fork per trial even if nothing times out, and the fork copies the state of the runner
+    process, which should therefore not run threads that hold locks (e.g., event sink writers or
+    BLAS pools) at that moment. An evaluation that exceeds its deadline is answered as
+    unevaluable and its process is killed. The process is not replaced, because the state of the
+    evaluator is lost with it, so any later step of that evaluator is also unevaluable.
+    """
+
+    def __init__(
+        self,
+        factory: ProblemFactory,
+        stdin: Optional[BinaryIO] = None,
+        stdout: Optional[BinaryIO] = None,
+        binary_framing: bool = False,
+        evaluate_timeout: Optional[float] = None,
+        evaluate_timeout_per_step: Optional[float] = None,
+        event_sink: Optional["EventSink"] = None,
+        thread_governor: Optional[threads.ThreadGovernor] = None,
+    ):
+        if thread_governor is not None:
+            thread_governor.limit()
+
         self._factory = factory
+        self._stdin = sys.stdin.buffer if stdin is None else stdin
+        self._stdout = sys.stdout.buffer if stdout is None else stdout
+        self._binary_framing = binary_framing
+        self._binary_framing_enabled = False
+        self._evaluate_timeout = evaluate_timeout
+        self._evaluate_timeout_per_step = evaluate_timeout_per_step
+        self._event_sink = event_sink
+        self._thread_governor = thread_governor
+        self._spec = None  # type: Optional[ProblemSpec]
         self._problems = {}  # type: Dict[int, Problem]
         self._evaluators = {}  # type: Dict[int, Evaluator]
+        self._evaluator_params = {}  # type: Dict[int, Tuple[int, List[Optional[float]]]]
+        self._n_timeouts = 0
+
+    @property
+    def n_timeouts(self) -> int:
+        """The number of evaluations that were killed because they exceeded the deadline."""
+
+        return self._n_timeouts
 
     def run(self):
+        if self._thread_governor is not None:
+            self._thread_governor.pin()
+
         self._cast_problem_spec()
 
-        while self._run_once():
-            pass
+        try:
+            while self._run_once():
+                pass
+        finally:
+            for evaluator in self._evaluators.values():
+                evaluator.close()
+            self._evaluators.clear()
+
+            for problem in self._problems.values():
+                problem.close()
+            self._problems.clear()
+
+            if self._event_sink is not None:
+                self._event_sink.flush()
 
     def _run_once(self) -> bool:
         message = self._recv_message()
@@ -287,7 +463,9 @@ class ProblemRunner(object):
             return False
 
         message_type = message["type"]
-        if message_type == "CREATE_PROBLEM_CAST":
+        if message_type == "SET_FRAMING_CAST":
+            self._handle_set_framing_cast(message)
+        elif message_type == "CREATE_PROBLEM_CAST":
             self._handle_create_problem_cast(message)
         elif message_type == "DROP_PROBLEM_CAST":
             self._handle_drop_problem_cast(message)
@@ -309,15 +487,21 @@ class ProblemRunner(object):
 
         problem = self._factory.create_problem(random_seed)
         self._problems[problem_id] = problem
+        if self._thread_governor is not None:
+            self._thread_governor.report("problem_id={}".format(problem_id))
 
     def _handle_drop_problem_cast(self, message):
         problem_id = message["problem_id"]
-        del self._problems[problem_id]
+        problem = self._problems.pop(problem_id)
+        problem.close()
 
     def _handle_create_evaluator_call(self, message):
         problem_id = message["problem_id"]
         evaluator_id = message["evaluator_id"]
         params = message["params"]
+        if self._binary_framing_enabled and not isinstance(params, list):
+            # Framed parameters are NumPy arrays, but problems expect a list of floats.
+            params = [float(p) for p in params]
         assert evaluator_id not in self._evaluators
 
         problem = self._problems[problem_id]
@@ -325,35 +509,120 @@ class ProblemRunner(object):
         if evaluator is None:
             self._send_message({"type": "ERROR_REPLY", "kind": "UNEVALABLE_PARAMS"})
         else:
+            if self._evaluate_timeout is not None or self._evaluate_timeout_per_step is not None:
+                evaluator = _EvaluatorWorker(
+                    evaluator,
+                    self._evaluate_timeout or 0.0,
+                    self._evaluate_timeout_per_step or 0.0,
+                )
             self._evaluators[evaluator_id] = evaluator
+            if self._event_sink is not None:
+                self._evaluator_params[evaluator_id] = (problem_id, params)
             self._send_message({"type": "CREATE_EVALUATOR_REPLY"})
 
     def _handle_drop_evaluator_cast(self, message):
         evaluator_id = message["evaluator_id"]
-        del self._evaluators[evaluator_id]
+        evaluator = self._evaluators.pop(evaluator_id)
+        evaluator.close()
+        self._evaluator_params.pop(evaluator_id, None)
 
     def _handle_evaluate_call(self, message):
         evaluator_id = message["evaluator_id"]
         next_step = message["next_step"]
 
         evaluator = self._evaluators[evaluator_id]
-        values = evaluator.evaluate(next_step)
-        current_step = evaluator.current_step()
+        start = time.time()
+        try:
+            values = evaluator.evaluate(next_step)
+            current_step = evaluator.current_step()
+        except _EvaluationTimeout as e:
+            if e.killed:
+                self._n_timeouts += 1
+                _logger.warning(
+                    "Evaluation timed out: evaluator_id={}, next_step={}, timeouts={}".format(
+                        evaluator_id, next_step, self._n_timeouts
+                    )
+                )
+            values = []
+            current_step = None
+
+        if self._event_sink is not None:
+            problem_id, params = self._evaluator_params[evaluator_id]
+            self._event_sink.record_evaluate(
+                problem_id,
+                evaluator_id,
+                params,
+                current_step,
+                values,
+                start,
+                time.time() - start,
+            )
+
+        if current_step is None:
+            self._send_message({"type": "ERROR_REPLY", "kind": "UNEVALABLE_PARAMS"})
+            return
 
         self._send_message(
             {"type": "EVALUATE_REPLY", "current_step": current_step, "values": values}
         )
 
+    def serve(self, path: str, max_sessions: int = 256):
+        """Serves problem sessions on a Unix domain socket instead of the stdio.
+
+        See `kurobako.server` for details. Runners with an event sink cannot serve, because every
+        session runs in a forked process and an `EventSink` must not be shared by processes.
+        """
+
+        if self._event_sink is not None:
+            raise ValueError("`serve` does not support event sinks.")
+
+        self._spec = self._factory.specification()
+
+        def run_session(stdin: BinaryIO, stdout: BinaryIO):
+            self._stdin = stdin
+            self._stdout = stdout
+            self.run()
+
+        # `kurobako.server` needs `os.fork` and Unix domain sockets, which are not available on
+        # every platform.
+        from kurobako import server
+
+        server.serve(path, run_session, max_sessions)
+
     def _cast_problem_spec(self):
-        spec = self._factory.specification()
-        self._send_message({"type": "PROBLEM_SPEC_CAST", "spec": spec.to_dict()})
+        if self._spec is None:
+            self._spec = self._factory.specification()
+
+        spec = self._spec.to_dict()
+        spec["attrs"] = dict(spec["attrs"])
+        if self._binary_framing:
+            spec["attrs"][framing.FRAMING_ATTR] = "binary"
+        if self._thread_governor is not None:
+            spec["attrs"][threads.THREADS_ATTR] = self._thread_governor.describe()
+        self._send_message({"type": "PROBLEM_SPEC_CAST", "spec": spec})
+
+    def _handle_set_framing_cast(self, message: Dict[str, Any]):
+        if not self._binary_framing or message["framing"] != "binary":
+            raise ValueError("Unsupported framing: {}".format(message))
+
+        self._binary_framing_enabled = True
 
     def _send_message(self, message: Dict[str, Any]):
-        print(json.dumps(message))
+        if self._binary_framing_enabled:
+            framing.write_message(self._stdout, message)
+            return
+
+        self._stdout.write(json.dumps(message).encode("utf-8") + b"\n")
+        self._stdout.flush()
 
     def _recv_message(self) -> Optional[Dict[str, Any]]:
         try:
-            message = input()
+            if self._binary_framing_enabled:
+                return framing.read_message(self._stdin)
+
+            message = self._stdin.readline()
+            if len(message) == 0:
+                return None
             return json.loads(message)
         except Exception:
             return None
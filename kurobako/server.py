@@ -0,0 +1,45 @@
+"""A Unix domain socket server that hosts solver or problem sessions.
+
+Each connection is a session that speaks the same line-delimited JSON protocol as the stdio of a
+solver or problem process. Sessions run in processes forked from the server, so the factory and
+everything it has loaded or cached are shared with every session without paying the startup cost
+again. Use `kurobako.shim` to connect kurobako's stdio to the server.
+"""
+
+import os
+import socketserver
+import stat
+from typing import BinaryIO
+from typing import Callable
+
+
+class _SessionHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.run_session(self.rfile, self.wfile)  # type: ignore
+
+
+class _ForkingUnixStreamServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+def serve(path: str, run_session: Callable[[BinaryIO, BinaryIO], None], max_sessions: int = 256):
+    """Serves sessions on a Unix domain socket bound to ``path`` until interrupted.
+
+    ``run_session`` is called with the input and the output stream of each connection in a forked
+    process. At most ``max_sessions`` sessions run concurrently.
+    """
+
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        # A stale socket left by a server that was not shut down cleanly.
+        os.unlink(path)
+
+    server = _ForkingUnixStreamServer(path, _SessionHandler)
+    server.max_children = max_sessions
+    server.run_session = run_session  # type: ignore
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
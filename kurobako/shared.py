@@ -0,0 +1,141 @@
+"""Resources shared by all the problems created by a factory.
+
+A problem factory is asked for a new problem for every seed, and problems that load a dataset or
+pretrained weights in `ProblemFactory.create_problem` reload them every time. A `SharedResource`
+is declared once by the factory, loaded on the first `acquire` and reused until the last problem
+that acquired it releases it:
+
+.. code-block:: python
+
+    class DatasetProblemFactory(problem.ProblemFactory):
+        def __init__(self):
+            self._dataset = SharedResource(load_dataset)
+
+        def create_problem(self, seed):
+            return DatasetProblem(self._dataset, seed)
+
+    class DatasetProblem(problem.Problem):
+        def __init__(self, dataset, seed):
+            self._dataset = dataset
+            self._x, self._y = dataset.acquire()
+
+        def close(self):
+            self._dataset.release()
+
+The NumPy arrays returned by the loader (at the top level, or in lists, tuples and dictionaries)
+are moved to memory-mapped files, in ``/dev/shm`` if it has enough free space and in the temporary
+directory otherwise, and mapped copy-on-write. They are read without copying by every problem and
+by the forked evaluation workers of `ProblemRunner`, and a write only copies the written pages into
+the writing process.
+"""
+
+import os
+import tempfile
+import threading
+from typing import Any
+from typing import Callable
+from typing import List
+from typing import Optional
+
+
+def _default_directories(nbytes: int) -> List[str]:
+    # `/dev/shm` is often small (e.g., 64 MB in Docker), so it is only tried if the array fits.
+    directories = []
+    if os.path.isdir("/dev/shm") and hasattr(os, "statvfs"):
+        stat = os.statvfs("/dev/shm")
+        if stat.f_bavail * stat.f_frsize > nbytes:
+            directories.append("/dev/shm")
+    directories.append(tempfile.gettempdir())
+    return directories
+
+
+class SharedResource(object):
+    def __init__(
+        self,
+        loader: Callable[[], Any],
+        directory: Optional[str] = None,
+        min_mapped_bytes: int = 1 << 20,
+    ):
+        self._loader = loader
+        self._directory = directory
+        self._min_mapped_bytes = min_mapped_bytes
+
+        self._lock = threading.Lock()
+        self._value = None  # type: Any
+        self._n_references = 0
+        self._paths = []  # type: List[str]
+
+    @property
+    def n_references(self) -> int:
+        return self._n_references
+
+    def acquire(self) -> Any:
+        """Returns the resource, loading it if nobody holds it."""
+
+        with self._lock:
+            if self._n_references == 0:
+                self._value = self._share(self._loader())
+            self._n_references += 1
+            return self._value
+
+    def release(self):
+        """Releases a reference taken by `acquire`, and frees the resource if it was the last."""
+
+        with self._lock:
+            if self._n_references == 0:
+                raise RuntimeError("The resource is not acquired.")
+
+            self._n_references -= 1
+            if self._n_references == 0:
+                # The memory maps are unmapped once the arrays are no longer referenced.
+                self._value = None
+                for path in self._paths:
+                    os.remove(path)
+                self._paths = []
+
+    def _share(self, value: Any) -> Any:
+        if isinstance(value, dict):
+            return {k: self._share(v) for k, v in value.items()}
+        elif isinstance(value, list):
+            return [self._share(v) for v in value]
+        elif isinstance(value, tuple) and not hasattr(value, "_fields"):
+            return tuple(self._share(v) for v in value)
+        elif type(value).__name__ == "ndarray" and value.nbytes >= self._min_mapped_bytes:
+            return self._map(value)
+        else:
+            return value
+
+    def _map(self, array: Any) -> Any:
+        import numpy as np
+
+        if array.dtype.hasobject:
+            return array
+
+        if self._directory is None:
+            directories = _default_directories(array.nbytes)
+        else:
+            directories = [self._directory]
+
+        for i, directory in enumerate(directories):
+            fd, path = tempfile.mkstemp(prefix="kurobako-shared-", suffix=".npy", dir=directory)
+            os.close(fd)
+
+            try:
+                np.save(path, array)
+                mapped = np.load(path, mmap_mode="c")
+                break
+            except OSError:
+                # E.g., the directory ran out of space while writing. Tries the next one.
+                os.remove(path)
+                if i == len(directories) - 1:
+                    raise
+            except Exception:
+                os.remove(path)
+                raise
+
+        if os.name == "posix":
+            # The mapping outlives its path, and nothing is left behind if the process dies.
+            os.remove(path)
+        else:
+            self._paths.append(path)
+        return mapped
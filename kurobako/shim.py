@@ -0,0 +1,54 @@
+"""Forwards the stdio of a solver or problem process to a session of `kurobako.server`.
+
+Usage: python -m kurobako.shim SOCKET_PATH
+
+This module only depends on the standard library, so the shim starts in a few milliseconds while
+the factory, the parsed specifications and the imported modules stay warm in the server.
+"""
+
+import os
+import selectors
+import socket
+import sys
+
+_BUFFER_SIZE = 65536
+
+
+def _write_all(fd: int, data: bytes):
+    while len(data) > 0:
+        n = os.write(fd, data)
+        data = data[n:]
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.stderr.write("Usage: {} SOCKET_PATH\n".format(sys.argv[0]))
+        sys.exit(1)
+
+    stdin = sys.stdin.fileno()
+    stdout = sys.stdout.fileno()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(sys.argv[1])
+
+    selector = selectors.DefaultSelector()
+    selector.register(stdin, selectors.EVENT_READ)
+    selector.register(sock, selectors.EVENT_READ)
+    while True:
+        for key, _ in selector.select():
+            if key.fileobj == stdin:
+                data = os.read(stdin, _BUFFER_SIZE)
+                if len(data) == 0:
+                    selector.unregister(stdin)
+                    sock.shutdown(socket.SHUT_WR)
+                else:
+                    sock.sendall(data)
+            else:
+                data = sock.recv(_BUFFER_SIZE)
+                if len(data) == 0:
+                    return
+                _write_all(stdout, data)
+
+
+if __name__ == "__main__":
+    main()
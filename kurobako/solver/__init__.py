@@ -1,16 +1,38 @@
 import abc
+import concurrent.futures
 import copy
 import enum
 import json
-import numpy as np
+import logging
+import math
+import random
+import sys
+import time
 from typing import Any
+from typing import BinaryIO
 from typing import Dict
 from typing import List
 from typing import Optional
 from typing import Set
-
+from typing import Tuple  # NOQA
+from typing import TYPE_CHECKING
+
+from kurobako import framing
+from kurobako import threads
+from kurobako.problem import CategoricalRange
+from kurobako.problem import DiscreteRange
+from kurobako.problem import Distribution
 from kurobako.problem import ProblemSpec
 
+if TYPE_CHECKING:
+    from kurobako.events import EventSink  # NOQA
+
+# Seeds are folded into the range of `numpy.uint32` (NumPy is not imported here to keep the startup
+# of solver processes fast).
+_MAX_SEED = 4294967295
+
+_logger = logging.getLogger(__name__)
+
 
 class Capability(enum.Enum):
     UNIFORM_CONTINUOUS = 0
@@ -162,6 +184,16 @@ class Solver(object):
     def tell(self, trial: EvaluatedTrial):
         raise NotImplementedError
 
+    def tell_fallback(self, params: List[Optional[float]], trial: EvaluatedTrial):
+        # Called with the evaluation of a trial that `SolverRunner` sampled on behalf of the
+        # solver because `ask` exceeded its latency budget. Override this to learn from it.
+        pass
+
+    def close(self):
+        # Called when the solver is dropped. Override this to release resources or flush
+        # buffered state.
+        pass
+
 
 class SolverFactory(object):
     @abc.abstractmethod
@@ -173,16 +205,247 @@ class SolverFactory(object):
         raise NotImplementedError
 
 
+class _RandomSampler(object):
+    # Samples parameters uniformly (or log-uniformly) from a problem's domain.
+    def __init__(self, problem: ProblemSpec, seed: int):
+        self._problem = problem
+        self._rng = random.Random(seed)
+
+    def is_supported(self) -> bool:
+        for p in self._problem.params:
+            if isinstance(p.range, CategoricalRange):
+                continue
+            if not (math.isfinite(p.range.low) and math.isfinite(p.range.high)):
+                return False
+            if p.distribution == Distribution.LOG_UNIFORM and p.range.low <= 0:
+                return False
+        return True
+
+    def sample(self) -> List[Optional[float]]:
+        params = []  # type: List[Optional[float]]
+        for p in self._problem.params:
+            if not p.is_constraint_satisfied(self._problem.params, params):
+                params.append(None)
+            elif isinstance(p.range, CategoricalRange):
+                params.append(self._rng.randrange(len(p.range.choices)))
+            elif isinstance(p.range, DiscreteRange):
+                last = int(p.range.high) - 1
+                if p.distribution == Distribution.LOG_UNIFORM:
+                    log_low = math.log(p.range.low)
+                    log_high = math.log(p.range.high)
+                    params.append(min(int(math.exp(self._rng.uniform(log_low, log_high))), last))
+                else:
+                    params.append(self._rng.randint(int(p.range.low), last))
+            elif p.distribution == Distribution.LOG_UNIFORM:
+                log_low = math.log(p.range.low)
+                log_high = math.log(p.range.high)
+                params.append(math.exp(self._rng.uniform(log_low, log_high)))
+            else:
+                params.append(self._rng.uniform(p.range.low, p.range.high))
+        return params
+
+
+class _BudgetedSolver(Solver):
+    """Bounds the latency of `Solver.ask` by falling back to random sampling.
+
+    The wrapped solver is called from a single background thread. If it does not answer an ask
+    within ``budget`` seconds, a random trial is returned instead, and the late answer is returned
+    by the next ask. Tells are queued behind the pending ask, so they never wait for it.
+
+    The wrapped solver generates trial ids of its own, which are mapped to the ids that kurobako
+    allocates when the trials are returned.
+    """
+
+    def __init__(self, solver: Solver, problem: ProblemSpec, seed: int, budget: float):
+        self._solver = solver
+        self._problem = problem
+        self._budget = budget
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending = None  # type: Optional[concurrent.futures.Future]
+        self._error = None  # type: Optional[BaseException]
+
+        self._sampler = _RandomSampler(problem, seed)
+        self._can_fall_back = self._sampler.is_supported()
+        self._solver_idg = TrialIdGenerator(0)
+        self._solver_ids = {}  # type: Dict[int, int]
+        self._kurobako_ids = {}  # type: Dict[int, int]
+        self._fallbacks = {}  # type: Dict[int, List[Optional[float]]]
+
+        self.n_asks = 0
+        self.n_fallbacks = 0
+        self.latencies = []  # type: List[float]
+
+    def ask(self, idg: TrialIdGenerator) -> NextTrial:
+        self._check_error()
+
+        start = time.perf_counter()
+        if self._pending is None:
+            self._pending = self._executor.submit(self._solver.ask, self._solver_idg)
+
+        try:
+            timeout = self._budget if self._can_fall_back else None
+            trial = self._pending.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            trial_id = idg.generate()
+            params = self._sampler.sample()
+            self._fallbacks[trial_id] = params
+            self.n_fallbacks += 1
+            next_trial = NextTrial(trial_id, params, self._problem.last_step)
+        else:
+            self._pending = None
+
+            solver_trial_id = trial.trial_id
+            if solver_trial_id in self._kurobako_ids:
+                trial_id = self._kurobako_ids[solver_trial_id]
+            else:
+                trial_id = idg.generate()
+                self._kurobako_ids[solver_trial_id] = trial_id
+                self._solver_ids[trial_id] = solver_trial_id
+
+            if trial.next_step is None:
+                # The trial is finished, and will not be told.
+                del self._kurobako_ids[solver_trial_id]
+                del self._solver_ids[trial_id]
+            next_trial = NextTrial(trial_id, trial.params, trial.next_step)
+
+        self.n_asks += 1
+        self.latencies.append(time.perf_counter() - start)
+        return next_trial
+
+    def tell(self, trial: EvaluatedTrial):
+        self._check_error()
+
+        values = list(trial.values)
+        if trial.trial_id in self._fallbacks:
+            params = self._fallbacks.pop(trial.trial_id)
+            trial = EvaluatedTrial(trial.trial_id, values, trial.current_step)
+            future = self._executor.submit(self._solver.tell_fallback, params, trial)
+        else:
+            solver_trial_id = self._solver_ids[trial.trial_id]
+            if trial.current_step == self._problem.last_step:
+                # The trial is finished, and will not be asked again.
+                del self._solver_ids[trial.trial_id]
+                del self._kurobako_ids[solver_trial_id]
+            trial = EvaluatedTrial(solver_trial_id, values, trial.current_step)
+            future = self._executor.submit(self._solver.tell, trial)
+        future.add_done_callback(self._on_tell_done)
+
+    def close(self):
+        # Waits for the pending ask, if any. Its trial is never evaluated.
+        self._executor.shutdown(wait=True)
+        self._solver.close()
+        self._check_error()
+
+    def _on_tell_done(self, future: concurrent.futures.Future):
+        if future.exception() is not None and self._error is None:
+            self._error = future.exception()
+
+    def _check_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+
+def _ask_stats(n_asks: int, n_fallbacks: int, latencies: List[float]) -> Dict[str, float]:
+    return {
+        "asks": n_asks,
+        "fallbacks": n_fallbacks,
+        "fallback_rate": n_fallbacks / n_asks if n_asks > 0 else 0.0,
+        "mean_latency": sum(latencies) / len(latencies) if len(latencies) > 0 else 0.0,
+        "max_latency": max(latencies, default=0.0),
+    }
+
+
 class SolverRunner(object):
-    def __init__(self, factory: SolverFactory):
+    def __init__(
+        self,
+        factory: SolverFactory,
+        stdin: Optional[BinaryIO] = None,
+        stdout: Optional[BinaryIO] = None,
+        binary_framing: bool = False,
+        event_sink: Optional["EventSink"] = None,
+        thread_governor: Optional[threads.ThreadGovernor] = None,
+        ask_budget: Optional[float] = None,
+    ):
+        if thread_governor is not None:
+            thread_governor.limit()
+
         self._factory = factory
+        self._stdin = sys.stdin.buffer if stdin is None else stdin
+        self._stdout = sys.stdout.buffer if stdout is None else stdout
+        self._binary_framing = binary_framing
+        self._binary_framing_enabled = False
+        self._event_sink = event_sink
+        self._thread_governor = thread_governor
+        self._ask_budget = ask_budget
+        self._spec = None  # type: Optional[SolverSpec]
         self._solvers = {}  # type: Dict[int, Solver]
+        self._n_asks = 0
+        self._n_fallbacks = 0
+        self._ask_latencies = []  # type: List[float]
+
+    def ask_stats(self) -> Dict[str, float]:
+        """Returns the number of asks, the fallback rate and the ask latencies (in seconds).
+
+        Fallbacks only happen if the runner was created with ``ask_budget``, and the latencies
+        are only measured in that case.
+        """
+
+        n_asks = self._n_asks
+        n_fallbacks = self._n_fallbacks
+        latencies = list(self._ask_latencies)
+        for solver in self._solvers.values():
+            if isinstance(solver, _BudgetedSolver):
+                n_asks += solver.n_asks
+                n_fallbacks += solver.n_fallbacks
+                latencies += solver.latencies
+        return _ask_stats(n_asks, n_fallbacks, latencies)
 
     def run(self):
+        if self._thread_governor is not None:
+            self._thread_governor.pin()
+
         self._cast_solver_spec()
 
-        while self._run_once():
-            pass
+        try:
+            while self._run_once():
+                pass
+        finally:
+            # Every solver is closed (e.g., flushes its buffered trials) even if another fails.
+            error = None  # type: Optional[Exception]
+            for solver_id in list(self._solvers):
+                try:
+                    self._close_solver(solver_id)
+                except Exception as e:
+                    if error is None:
+                        error = e
+
+            if self._event_sink is not None:
+                self._event_sink.flush()
+            if error is not None:
+                raise error
+
+    def _close_solver(self, solver_id: int):
+        solver = self._solvers.pop(solver_id)
+        solver.close()
+
+        if isinstance(solver, _BudgetedSolver):
+            stats = _ask_stats(solver.n_asks, solver.n_fallbacks, solver.latencies)
+            # Logged as a warning, so that it is shown even if logging is not configured.
+            _logger.warning(
+                "Ask latency budget: solver_id={}, asks={}, fallback_rate={:.3f}, mean={:.3f}s, "
+                "max={:.3f}s".format(
+                    solver_id,
+                    solver.n_asks,
+                    stats["fallback_rate"],
+                    stats["mean_latency"],
+                    stats["max_latency"],
+                )
+            )
+            self._n_asks += solver.n_asks
+            self._n_fallbacks += solver.n_fallbacks
+            self._ask_latencies += solver.latencies
 
     def _run_once(self) -> bool:
         message = self._recv_message()
@@ -190,7 +453,9 @@ class SolverRunner(object):
             return False
 
         message_type = message["type"]
-        if message_type == "CREATE_SOLVER_CAST":
+        if message_type == "SET_FRAMING_CAST":
+            self._handle_set_framing_cast(message)
+        elif message_type == "CREATE_SOLVER_CAST":
             self._handle_create_solver_cast(message)
         elif message_type == "DROP_SOLVER_CAST":
             self._handle_drop_solver_cast(message)
@@ -209,13 +474,16 @@ class SolverRunner(object):
         problem = ProblemSpec.from_dict(message["problem"])
         assert solver_id not in self._solvers
 
-        random_seed = random_seed % np.iinfo(np.uint32).max
+        random_seed = random_seed % _MAX_SEED
         solver = self._factory.create_solver(random_seed, problem)
+        if self._ask_budget is not None:
+            solver = _BudgetedSolver(solver, problem, random_seed, self._ask_budget)
         self._solvers[solver_id] = solver
+        if self._thread_governor is not None:
+            self._thread_governor.report("solver_id={}".format(solver_id))
 
     def _handle_drop_solver_cast(self, message: Dict[str, Any]):
-        solver_id = message["solver_id"]
-        del self._solvers[solver_id]
+        self._close_solver(message["solver_id"])
 
     def _handle_ask_call(self, message: Dict[str, Any]):
         solver_id = message["solver_id"]
@@ -223,7 +491,10 @@ class SolverRunner(object):
 
         idg = TrialIdGenerator(next_trial_id)
         solver = self._solvers[solver_id]
+        start = time.time()
         trial = solver.ask(idg)
+        if self._event_sink is not None:
+            self._event_sink.record_ask(solver_id, trial, start, time.time() - start)
 
         message = {
             "type": "ASK_REPLY",
@@ -235,23 +506,81 @@ class SolverRunner(object):
     def _handle_tell_call(self, message: Dict[str, Any]):
         solver_id = message["solver_id"]
         trial = EvaluatedTrial.from_dict(message["trial"])
+        if self._binary_framing_enabled:
+            # Framed values are NumPy arrays, but solvers expect a list of floats.
+            trial.values = [float(v) for v in trial.values]
 
         solver = self._solvers[solver_id]
-        solver.tell(trial)
+        start = time.time()
+        if self._event_sink is None:
+            solver.tell(trial)
+        else:
+            # `Solver.tell` may modify `trial.values` in place.
+            values = list(trial.values)
+            solver.tell(trial)
+            trial.values = values
+            self._event_sink.record_tell(solver_id, trial, start, time.time() - start)
 
         message = {"type": "TELL_REPLY"}
         self._send_message(message)
 
+    def serve(self, path: str, max_sessions: int = 256):
+        """Serves solver sessions on a Unix domain socket instead of the stdio.
+
+        See `kurobako.server` for details. Runners with an event sink cannot serve, because every
+        session runs in a forked process and an `EventSink` must not be shared by processes.
+        """
+
+        if self._event_sink is not None:
+            raise ValueError("`serve` does not support event sinks.")
+
+        self._spec = self._factory.specification()
+
+        def run_session(stdin: BinaryIO, stdout: BinaryIO):
+            self._stdin = stdin
+            self._stdout = stdout
+            self.run()
+
+        # `kurobako.server` needs `os.fork` and Unix domain sockets, which are not available on
+        # every platform.
+        from kurobako import server
+
+        server.serve(path, run_session, max_sessions)
+
     def _cast_solver_spec(self):
-        spec = self._factory.specification()
-        self._send_message({"type": "SOLVER_SPEC_CAST", "spec": spec.to_dict()})
+        if self._spec is None:
+            self._spec = self._factory.specification()
+
+        spec = self._spec.to_dict()
+        spec["attrs"] = dict(spec["attrs"])
+        if self._binary_framing:
+            spec["attrs"][framing.FRAMING_ATTR] = "binary"
+        if self._thread_governor is not None:
+            spec["attrs"][threads.THREADS_ATTR] = self._thread_governor.describe()
+        self._send_message({"type": "SOLVER_SPEC_CAST", "spec": spec})
+
+    def _handle_set_framing_cast(self, message: Dict[str, Any]):
+        if not self._binary_framing or message["framing"] != "binary":
+            raise ValueError("Unsupported framing: {}".format(message))
+
+        self._binary_framing_enabled = True
 
     def _send_message(self, message: Dict[str, Any]):
-        print(json.dumps(message))
+        if self._binary_framing_enabled:
+            framing.write_message(self._stdout, message)
+            return
+
+        self._stdout.write(json.dumps(message).encode("utf-8") + b"\n")
+        self._stdout.flush()
 
     def _recv_message(self) -> Optional[Dict[str, Any]]:
         try:
-            message = input()
+            if self._binary_framing_enabled:
+                return framing.read_message(self._stdin)
+
+            message = self._stdin.readline()
+            if len(message) == 0:
+                return None
             return json.loads(message)
         except Exception:
             return None
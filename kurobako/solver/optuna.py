@@ -1,44 +1,102 @@
-import optuna
-from optuna.version import __version__ as optuna_ver
-from packaging import version
-from pkg_resources import DistributionNotFound
-from pkg_resources import get_distribution
+import atexit
+import copy
+import functools
+import json
+import logging
 import queue
+import threading
+import time
+from typing import Any  # NOQA
 from typing import Callable
 from typing import Dict  # NOQA
 from typing import List  # NOQA
 from typing import Optional  # NOQA
 from typing import Tuple  # NOQA
+from typing import TYPE_CHECKING
 
 from kurobako import problem
 from kurobako import solver
+from kurobako import threads
 
-_optuna_logger = optuna.logging.get_logger(__name__)
+if TYPE_CHECKING:
+    # Optuna is imported lazily by the functions that need it, because kurobako spawns a fresh
+    # solver process for every run and importing Optuna dominates its startup time.
+    import optuna  # NOQA
+
+_optuna_logger = logging.getLogger(__name__)
+
+_PROBLEM_DIGEST_ATTR = "kurobako:problem_digest"
+_SEED_ATTR = "kurobako:seed"
+# Marks the trials that were injected from prior results, so that they are not loaded again.
+_PRIOR_ATTR = "kurobako:prior"
+
+# Write-behind mode copies finished trials to the durable storage at most every
+# `_WRITE_BEHIND_INTERVAL` seconds, in batches of up to `_WRITE_BEHIND_BATCH_SIZE` trials.
+_WRITE_BEHIND_INTERVAL = 1.0
+_WRITE_BEHIND_BATCH_SIZE = 1000
+
+# The parameters and the final values of a trial in a kurobako result file.
+_Record = Tuple[List[Optional[float]], List[float]]
+
+
+@functools.lru_cache(maxsize=None)
+def _distribution_version(name: str) -> str:
+    try:
+        from importlib.metadata import PackageNotFoundError
+        from importlib.metadata import version
+    except ImportError:
+        # Python < 3.8.
+        from pkg_resources import DistributionNotFound as PackageNotFoundError  # type: ignore
+        from pkg_resources import get_distribution
+
+        def version(name: str) -> str:  # type: ignore
+            return get_distribution(name).version
+
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return "unknown"
+
+
+@functools.lru_cache(maxsize=None)
+def _tell_returns_frozen_trial() -> bool:
+    from optuna.version import __version__ as optuna_ver
+    from packaging import version
+
+    return version.parse(optuna_ver) >= version.Version("3.0.0b0")
 
 
 class OptunaSolverFactory(solver.SolverFactory):
     def __init__(
         self,
-        create_study: Callable[[int], optuna.Study],
+        create_study: Callable[[int], "optuna.Study"],
         name: str = "Optuna",
         use_discrete_uniform: bool = False,
         warm_starting_trials: int = 0,
+        prior_results: Optional[str] = None,
+        write_behind: bool = False,
+        thread_governor: Optional[threads.ThreadGovernor] = None,
     ):
+        # Capping the thread pools here, before `create_study` first imports Optuna and its
+        # numerical dependencies, lets them start with the capped sizes.
+        if thread_governor is not None:
+            thread_governor.limit()
+
         self._create_study = create_study
         self._name = name
         self._use_discrete_uniform = use_discrete_uniform
         self._warm_starting_trials = warm_starting_trials
+        self._write_behind = write_behind
+        self._thread_governor = thread_governor
 
-    def specification(self) -> solver.SolverSpec:
-        try:
-            optuna_version = get_distribution("optuna").version
-        except DistributionNotFound:
-            optuna_version = "unknown"
+        if prior_results is None:
+            self._prior_results = None  # type: Optional[_PriorResults]
+        else:
+            self._prior_results = _PriorResults(prior_results, use_discrete_uniform)
 
-        try:
-            kurobako_version = get_distribution("kurobako").version
-        except DistributionNotFound:
-            kurobako_version = "unknown"
+    def specification(self) -> solver.SolverSpec:
+        optuna_version = _distribution_version("optuna")
+        kurobako_version = _distribution_version("kurobako")
 
         return solver.SolverSpec(
             name=self._name,
@@ -63,22 +121,294 @@ class OptunaSolverFactory(solver.SolverFactory):
 
     def create_solver(self, seed: int, problem: problem.ProblemSpec) -> solver.Solver:
         study = self._create_study(seed)
-        return OptunaSolver(
+        if self._thread_governor is not None:
+            # Caps the pools of the libraries that ignored the environment variables.
+            self._thread_governor.limit()
+
+        problem_digest = problem.digest()
+        study.set_user_attr(_PROBLEM_DIGEST_ATTR, problem_digest)
+        study.set_user_attr(_SEED_ATTR, seed)
+
+        optuna_solver = OptunaSolver(
             study,
             problem,
             use_discrete_uniform=self._use_discrete_uniform,
             warm_starting_trials=self._warm_starting_trials,
+            write_behind=self._write_behind,
+        )
+
+        if self._prior_results is not None:
+            trials = self._prior_results.trials(problem, problem_digest, seed, study.directions)
+            if len(trials) > 0:
+                optuna_solver._add_trials(trials)
+
+        return optuna_solver
+
+
+def _distribution(
+    v: problem.Var, use_discrete_uniform: bool
+) -> "optuna.distributions.BaseDistribution":
+    import optuna
+
+    log = v.distribution == problem.Distribution.LOG_UNIFORM
+    if isinstance(v.range, problem.ContinuousRange):
+        return optuna.distributions.FloatDistribution(v.range.low, v.range.high, log=log)
+    elif isinstance(v.range, problem.DiscreteRange):
+        if use_discrete_uniform:
+            return optuna.distributions.FloatDistribution(v.range.low, v.range.high - 1, step=1)
+        else:
+            return optuna.distributions.IntDistribution(
+                int(v.range.low), int(v.range.high) - 1, log=log
+            )
+    elif isinstance(v.range, problem.CategoricalRange):
+        return optuna.distributions.CategoricalDistribution(v.range.choices)
+
+    raise ValueError("Unsupported parameter: {}".format(v))
+
+
+def _trial_params(
+    spec: problem.ProblemSpec, params: List[Any], use_discrete_uniform: bool
+) -> Dict[str, Any]:
+    # Converts kurobako parameters into Optuna ones. Inactive parameters are left out.
+    trial_params = {}  # type: Dict[str, Any]
+    for v, p in zip(spec.params, params):
+        if p is None or p != p:
+            continue
+        if isinstance(v.range, problem.CategoricalRange):
+            trial_params[v.name] = v.range.choices[int(p)]
+        elif isinstance(v.range, problem.DiscreteRange) and not use_discrete_uniform:
+            trial_params[v.name] = int(p)
+        else:
+            trial_params[v.name] = p
+    return trial_params
+
+
+class _PriorResults(object):
+    """Completed trials loaded from the results of previous benchmark runs.
+
+    The source is either an Optuna journal file written by studies created through
+    `OptunaSolverFactory`, or a result file generated by `kurobako run`. It is loaded once on first
+    use and indexed, so that every solver created by a factory can pick up its matching trials
+    without re-reading the file.
+
+    Journal trials are matched by problem digest and seed. Trials that were themselves injected
+    from prior results are skipped, so that a journal that is both read and written does not
+    accumulate copies. The seeds that kurobako passes to solvers are drawn from the study seed
+    rather than equal to it, so result file trials are matched by problem digest only.
+    """
+
+    def __init__(self, path: str, use_discrete_uniform: bool):
+        self._path = path
+        self._use_discrete_uniform = use_discrete_uniform
+        self._journal = (
+            None
+        )  # type: Optional[Dict[Tuple[str, int], List[optuna.trial.FrozenTrial]]]
+        self._records = None  # type: Optional[Dict[str, List[_Record]]]
+
+    def trials(
+        self,
+        spec: problem.ProblemSpec,
+        problem_digest: str,
+        seed: int,
+        directions: List["optuna.study.StudyDirection"],
+    ) -> List["optuna.trial.FrozenTrial"]:
+        import optuna
+
+        if self._journal is None and self._records is None:
+            self._load()
+
+        if self._journal is not None:
+            trials = []
+            for trial in self._journal.get((problem_digest, seed), []):
+                if len(trial.values) != len(directions):
+                    continue
+
+                trial = copy.deepcopy(trial)
+                trial.system_attrs = dict(trial.system_attrs, **{_PRIOR_ATTR: True})
+                trials.append(trial)
+            return trials
+
+        assert self._records is not None
+        distributions = {v.name: _distribution(v, self._use_discrete_uniform) for v in spec.params}
+        trials = []
+        for params, values in self._records.get(problem_digest, []):
+            if len(values) != len(directions):
+                continue
+
+            values = [
+                -v if d == optuna.study.StudyDirection.MAXIMIZE else v
+                for v, d in zip(values, directions)
+            ]
+            trial_params = _trial_params(spec, params, self._use_discrete_uniform)
+            trials.append(
+                optuna.trial.create_trial(
+                    params=trial_params,
+                    distributions={name: distributions[name] for name in trial_params},
+                    values=values,
+                    system_attrs={_PRIOR_ATTR: True},
+                )
+            )
+        return trials
+
+    def _load(self):
+        with open(self._path) as f:
+            first_line = ""
+            for line in f:
+                if line.strip() != "":
+                    first_line = line
+                    break
+
+        try:
+            is_journal = "op_code" in json.loads(first_line)
+        except ValueError:
+            # A pretty-printed kurobako result file does not fit in a single line.
+            is_journal = False
+
+        if is_journal:
+            self._load_journal()
+        else:
+            self._load_records()
+
+    def _load_journal(self):
+        import optuna
+
+        storages = optuna.storages
+        if hasattr(storages, "journal") and hasattr(storages.journal, "JournalFileBackend"):
+            backend = storages.journal.JournalFileBackend(self._path)
+        else:
+            backend = storages.JournalFileStorage(self._path)
+        storage = storages.JournalStorage(backend)
+
+        self._journal = {}
+        for study in storage.get_all_studies():
+            if _PROBLEM_DIGEST_ATTR not in study.user_attrs or _SEED_ATTR not in study.user_attrs:
+                continue
+
+            key = (study.user_attrs[_PROBLEM_DIGEST_ATTR], study.user_attrs[_SEED_ATTR])
+            trials = storage.get_all_trials(
+                study._study_id, deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,)
+            )
+            trials = [t for t in trials if _PRIOR_ATTR not in t.system_attrs]
+            self._journal.setdefault(key, []).extend(trials)
+
+    def _load_records(self):
+        with open(self._path) as f:
+            content = f.read()
+
+        try:
+            records = json.loads(content)
+            if not isinstance(records, list):
+                records = [records]
+        except ValueError:
+            # `kurobako run` emits one study record per line.
+            records = [json.loads(line) for line in content.splitlines() if line.strip() != ""]
+
+        self._records = {}
+        for record in records:
+            spec = problem.ProblemSpec.from_dict(record["problem"]["spec"])
+            completed = self._records.setdefault(spec.digest(), [])
+            for trial in record["trials"]:
+                if len(trial["evaluations"]) == 0:
+                    continue
+
+                evaluation = trial["evaluations"][-1]
+                if evaluation["end_step"] != spec.last_step or len(evaluation["values"]) == 0:
+                    continue
+
+                completed.append((trial["params"], evaluation["values"]))
+
+
+class _WriteBehindWriter(object):
+    """Copies finished trials of an in-memory study to a durable study in the background.
+
+    The solver works on `study`, an in-memory mirror of the durable study, so that asks, reports
+    and pruning decisions never wait on the durable storage. Finished trials are handed over with
+    `put` and written to the durable study in batches by a background thread.
+    """
+
+    def __init__(self, durable_study: "optuna.Study"):
+        import optuna
+
+        self._durable_study = durable_study
+        self.study = optuna.create_study(
+            study_name=durable_study.study_name,
+            sampler=durable_study.sampler,
+            pruner=durable_study.pruner,
+            directions=durable_study.directions,
         )
+        for key, value in durable_study.user_attrs.items():
+            self.study.set_user_attr(key, value)
+
+        # Trials that are running elsewhere cannot be finished through the mirror.
+        states = tuple(s for s in optuna.trial.TrialState if s != optuna.trial.TrialState.RUNNING)
+        self.study.add_trials(durable_study.get_trials(deepcopy=False, states=states))
+
+        self._queue = queue.Queue()  # type: queue.Queue[Optional[int]]
+        self._error = None  # type: Optional[Exception]
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, trial_id: int):
+        self._queue.put(trial_id)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        atexit.unregister(self.close)
+
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def _run(self):
+        closed = False
+        while not closed:
+            trial_id = self._queue.get()
+            if trial_id is None:
+                break
+
+            trial_ids = [trial_id]
+            deadline = time.monotonic() + _WRITE_BEHIND_INTERVAL
+            while len(trial_ids) < _WRITE_BEHIND_BATCH_SIZE:
+                try:
+                    trial_id = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+                if trial_id is None:
+                    closed = True
+                    break
+                trial_ids.append(trial_id)
+
+            if self._error is not None:
+                # Keep draining the queue so that `close` does not block.
+                continue
+
+            try:
+                storage = self.study._storage
+                self._durable_study.add_trials(storage.get_trial(i) for i in trial_ids)
+            except Exception as e:
+                self._error = e
 
 
 class OptunaSolver(solver.Solver):
     def __init__(
         self,
-        study: optuna.Study,
+        study: "optuna.Study",
         problem: problem.ProblemSpec,
         use_discrete_uniform: bool = False,
         warm_starting_trials: int = 0,
+        write_behind: bool = False,
     ):
+        if write_behind:
+            self._writer = _WriteBehindWriter(study)  # type: Optional[_WriteBehindWriter]
+            study = self._writer.study
+        else:
+            self._writer = None
+
         self._study = study
         self._problem = problem
         self._use_discrete_uniform = use_discrete_uniform
@@ -86,8 +416,29 @@ class OptunaSolver(solver.Solver):
         self._waitings = queue.Queue()  # type: queue.Queue[Tuple[int, optuna.Trial]]
         self._pruned = queue.Queue()  # type: queue.Queue[Tuple[int, optuna.Trial]]
         self._runnings = {}  # type: Dict[int, optuna.Trial]
+        self._tell_returns_frozen_trial = _tell_returns_frozen_trial()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+    def _add_trials(self, trials: List["optuna.trial.FrozenTrial"]):
+        n_trials = len(self._study.get_trials(deepcopy=False))
+        self._study.add_trials(trials)
+
+        if self._writer is not None:
+            for trial in self._study.get_trials(deepcopy=False)[n_trials:]:
+                self._writer.put(trial._trial_id)
+
+    def _tell(self, trial: "optuna.Trial", **kwargs: Any) -> "optuna.trial.FrozenTrial":
+        frozen_trial = self._study.tell(trial, **kwargs)
+        if self._writer is not None:
+            self._writer.put(trial._trial_id)
+        return frozen_trial
 
     def _next_step(self, current_step: int) -> int:
+        import optuna
+
         if self._warm_starting_trials > 0:
             assert current_step == 0
             self._warm_starting_trials -= 1
@@ -136,7 +487,7 @@ class OptunaSolver(solver.Solver):
         self._runnings[kurobako_trial_id] = trial
         return solver.NextTrial(trial_id=kurobako_trial_id, params=params, next_step=next_step)
 
-    def _suggest(self, trial: optuna.Trial, v: problem.Var) -> float:
+    def _suggest(self, trial: "optuna.Trial", v: problem.Var) -> float:
         if v.name in trial.params:
             if isinstance(trial.params[v.name], str):
                 assert isinstance(v.range, problem.CategoricalRange)
@@ -163,6 +514,8 @@ class OptunaSolver(solver.Solver):
         raise ValueError("Unsupported parameter: {}".format(v))
 
     def tell(self, evaluated_trial: solver.EvaluatedTrial):
+        import optuna
+
         kurobako_trial_id = evaluated_trial.trial_id
         values = evaluated_trial.values
         current_step = evaluated_trial.current_step
@@ -174,7 +527,7 @@ class OptunaSolver(solver.Solver):
             message = "Unevaluable trial#{}: step={}".format(trial.number, current_step)
             _optuna_logger.info(message)
 
-            self._study.tell(trial, state=optuna.trial.TrialState.PRUNED)
+            self._tell(trial, state=optuna.trial.TrialState.PRUNED)
             return
 
         assert len(values) == len(self._study.directions)
@@ -184,8 +537,8 @@ class OptunaSolver(solver.Solver):
 
         assert current_step <= self._problem.last_step
         if self._problem.last_step == current_step:
-            frozen_trial = self._study.tell(trial, values=values)
-            if version.parse(optuna_ver) >= version.Version("3.0.0b0"):
+            frozen_trial = self._tell(trial, values=values)
+            if self._tell_returns_frozen_trial:
                 self._study._log_completed_trial(frozen_trial)
             else:
                 self._study._log_completed_trial(trial, values)
@@ -205,7 +558,37 @@ class OptunaSolver(solver.Solver):
                     trial.number, current_step, value
                 )
                 _optuna_logger.info(message)
-                self._study.tell(trial, state=optuna.trial.TrialState.PRUNED)
+                self._tell(trial, state=optuna.trial.TrialState.PRUNED)
                 self._pruned.put((kurobako_trial_id, trial))
             else:
                 self._waitings.put((kurobako_trial_id, trial))
+
+    def tell_fallback(self, params: List[Optional[float]], evaluated_trial: solver.EvaluatedTrial):
+        import optuna
+
+        trial_params = _trial_params(self._problem, params, self._use_discrete_uniform)
+        distributions = {
+            v.name: _distribution(v, self._use_discrete_uniform)
+            for v in self._problem.params
+            if v.name in trial_params
+        }
+        values = [
+            -v if d == optuna.study.StudyDirection.MAXIMIZE else v
+            for v, d in zip(evaluated_trial.values, self._study.directions)
+        ]
+
+        if len(values) > 0 and evaluated_trial.current_step == self._problem.last_step:
+            trial = optuna.trial.create_trial(
+                params=trial_params, distributions=distributions, values=values
+            )
+        else:
+            intermediate_values = {}  # type: Dict[int, float]
+            if len(values) == 1:
+                intermediate_values[evaluated_trial.current_step] = values[0]
+            trial = optuna.trial.create_trial(
+                params=trial_params,
+                distributions=distributions,
+                intermediate_values=intermediate_values,
+                state=optuna.trial.TrialState.PRUNED,
+            )
+        self._add_trials([trial])
@@ -0,0 +1,151 @@
+import os
+import sys
+import threading
+import warnings
+from typing import Dict
+from typing import List  # NOQA
+from typing import Optional  # NOQA
+
+try:
+    import threadpoolctl
+
+    _threadpoolctl_available = True
+except ImportError:
+    _threadpoolctl_available = False
+
+THREADS_ATTR = "kurobako-py.threads"
+
+# Set by launchers to give each governed process on a host its own CPU slot.
+CPU_INDEX_ENV_VAR = "KUROBAKO_CPU_INDEX"
+
+# Modules that load native thread pools when they are imported.
+_NATIVE_MODULES = ["numpy", "scipy", "torch", "sklearn", "numexpr"]
+
+# The environment variables that native libraries read to size their thread pools when they are
+# loaded.
+_THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+
+class ThreadGovernor(object):
+    """Caps the threads of a solver or problem process.
+
+    Kurobako runs many solver and problem processes in parallel, and each of them may start a
+    BLAS or OpenMP thread pool as large as the host. The governor caps those pools to
+    ``max_threads`` threads. Libraries loaded after `limit` pick the cap up from the environment,
+    and pools that are already loaded are capped through ``threadpoolctl`` if it is installed, so
+    `limit` should be called before heavy imports whenever possible.
+
+    If ``pin_cpus`` is `True`, `pin` restricts the process to the ``max_threads`` CPUs of its slot
+    among the CPUs initially available to it. The slot is ``cpu_index`` if given, or the
+    ``KUROBAKO_CPU_INDEX`` environment variable if set, so that a launcher that numbers its
+    processes can give them disjoint CPUs. Otherwise, the slot is derived from the process id,
+    which spreads the processes over the CPUs but does not guarantee that they are disjoint.
+    """
+
+    def __init__(
+        self, max_threads: int = 1, pin_cpus: bool = False, cpu_index: Optional[int] = None
+    ):
+        if max_threads < 1:
+            raise ValueError("`max_threads` must be positive, but got {}.".format(max_threads))
+
+        self._max_threads = max_threads
+        self._pin_cpus = pin_cpus and hasattr(os, "sched_setaffinity")
+        if self._pin_cpus:
+            self._cpus = sorted(os.sched_getaffinity(0))  # type: Optional[List[int]]
+        else:
+            self._cpus = None
+
+        if cpu_index is None and CPU_INDEX_ENV_VAR in os.environ:
+            cpu_index = int(os.environ[CPU_INDEX_ENV_VAR])
+        self._cpu_index = cpu_index
+        self._pinned_pid = None  # type: Optional[int]
+
+    def limit(self):
+        # Modules imported after the environment variables were set already honour the cap.
+        capped = all(os.environ.get(name) == str(self._max_threads) for name in _THREAD_ENV_VARS)
+        for name in _THREAD_ENV_VARS:
+            os.environ[name] = str(self._max_threads)
+
+        if _threadpoolctl_available:
+            threadpoolctl.threadpool_limits(limits=self._max_threads)
+            return
+
+        loaded = [name for name in _NATIVE_MODULES if name in sys.modules]
+        if not capped and len(loaded) > 0:
+            warnings.warn(
+                "The thread pools of already imported modules ({}) cannot be capped without "
+                "`threadpoolctl`. Install it (e.g., `pip install kurobako[threads]`), or create "
+                "the governor before importing them.".format(", ".join(loaded))
+            )
+
+    def pin(self):
+        """Pins this process to the CPUs of its slot, if ``pin_cpus`` is `True`.
+
+        The affinity applies to the whole process, so it is only set once per process. A forked
+        process (e.g., a session of `SolverRunner.serve`) is pinned again to its own slot.
+        """
+
+        if self._cpus is None or self._pinned_pid == os.getpid():
+            return
+        self._pinned_pid = os.getpid()
+
+        index = os.getpid() if self._cpu_index is None else self._cpu_index
+        n = min(self._max_threads, len(self._cpus))
+        start = (index * n) % len(self._cpus)
+        os.sched_setaffinity(0, [self._cpus[(start + i) % len(self._cpus)] for i in range(n)])
+
+    def effective_threads(self) -> Dict[str, int]:
+        """Returns the thread counts that are in effect in this process.
+
+        The result has the number of CPUs the process may run on (``cpus``), the number of live
+        Python threads (``python``) and, if ``threadpoolctl`` is installed, the total size of the
+        thread pools of each loaded native API (e.g., ``blas`` and ``openmp``).
+        """
+
+        if hasattr(os, "sched_getaffinity"):
+            cpus = len(os.sched_getaffinity(0))
+        else:
+            cpus = os.cpu_count() or 1
+
+        counts = {"cpus": cpus, "python": threading.active_count()}
+        if _threadpoolctl_available:
+            for pool in threadpoolctl.threadpool_info():
+                api = pool["user_api"]
+                counts[api] = counts.get(api, 0) + pool["num_threads"]
+        return counts
+
+    def describe(self) -> str:
+        """Returns the settings of the governor as a specification attribute.
+
+        The thread counts are not included, because the specification is cast before the solvers
+        or problems load their libraries. Use `effective_threads` for them.
+        """
+
+        items = ["max_threads={}".format(self._max_threads)]
+        if self._cpus is not None:
+            if self._cpu_index is None:
+                items.append("pin_cpus=pid")
+            else:
+                items.append("pin_cpus={}".format(self._cpu_index))
+        return ", ".join(items)
+
+    def report(self, owner: str):
+        """Writes the effective thread counts to the standard error.
+
+        The standard error is not part of kurobako's protocol, so the counts are visible without
+        configuring logging.
+        """
+
+        counts = self.effective_threads()
+        items = ["{}={}".format(k, v) for k, v in sorted(counts.items())]
+        print(
+            "kurobako-py: effective threads ({}): {}".format(owner, ", ".join(items)),
+            file=sys.stderr,
+        )
@@ -21,5 +21,6 @@ setup(
     license="MIT",
     packages=find_packages(),
     install_requires=["numpy"],
-    extras_require={"checking": ["hacking", "mypy", "black"]},
+    extras_require={"checking": ["hacking", "mypy", "black"], "threads": ["threadpoolctl"]},
+    entry_points={"console_scripts": ["kurobako-shim = kurobako.shim:main"]},
 )
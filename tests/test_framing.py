@@ -0,0 +1,95 @@
+import io
+import json
+import struct
+from typing import Any
+from typing import List
+
+import pytest
+
+from kurobako import framing
+from kurobako.solver import SolverRunner
+
+optuna = pytest.importorskip("optuna")
+from kurobako.solver.optuna import OptunaSolverFactory  # NOQA
+
+PROBLEM = {
+    "name": "quadratic",
+    "attrs": {},
+    "params_domain": [
+        {
+            "name": "x",
+            "range": {"type": "CONTINUOUS", "low": -1.0, "high": 1.0},
+            "distribution": "UNIFORM",
+            "constraint": None,
+        }
+    ],
+    "values_domain": [
+        {
+            "name": "y",
+            "range": {"type": "CONTINUOUS", "low": 0.0, "high": 1.0},
+            "distribution": "UNIFORM",
+            "constraint": None,
+        }
+    ],
+    "steps": [1],
+}
+
+
+@pytest.mark.parametrize(
+    "values,state",
+    [([0.25], "COMPLETE"), ([], "PRUNED")],  # An empty list means the trial was unevaluable.
+)
+def test_framed_tell_reaches_optuna(values: List[float], state: str) -> None:
+    studies = []
+
+    def create_study(seed: int) -> Any:
+        study = optuna.create_study(sampler=optuna.samplers.RandomSampler(seed=seed))
+        studies.append(study)
+        return study
+
+    messages = [
+        {"type": "CREATE_SOLVER_CAST", "solver_id": 0, "random_seed": 1, "problem": PROBLEM},
+        {"type": "ASK_CALL", "solver_id": 0, "next_trial_id": 0},
+        {
+            "type": "TELL_CALL",
+            "solver_id": 0,
+            "trial": {"id": 0, "values": values, "current_step": 1},
+        },
+    ]
+    stdin = io.BytesIO(
+        json.dumps(framing.SET_FRAMING_MESSAGE).encode("utf-8")
+        + b"\n"
+        + b"".join(framing.encode(m) for m in messages)
+    )
+    stdout = io.BytesIO()
+
+    runner = SolverRunner(
+        OptunaSolverFactory(create_study), stdin=stdin, stdout=stdout, binary_framing=True
+    )
+    runner.run()
+
+    stdout.seek(0)
+    spec = json.loads(stdout.readline())
+    assert spec["spec"]["attrs"][framing.FRAMING_ATTR] == "binary"
+    for reply_type in ["ASK_REPLY", "TELL_REPLY"]:
+        reply = framing.read_message(stdout)
+        assert reply is not None and reply["type"] == reply_type
+
+    (trial,) = studies[0].trials
+    assert trial.state == optuna.trial.TrialState[state]
+    if state == "COMPLETE":
+        assert trial.values == values
+
+
+def test_empty_arrays_round_trip() -> None:
+    message = {"type": "EVALUATE_REPLY", "current_step": 1, "values": []}
+    decoded = framing.read_message(io.BytesIO(framing.encode(message)))
+    assert decoded == message
+
+    # A peer may also send an empty array as a placeholder.
+    header = json.dumps(
+        {"type": "EVALUATE_REPLY", "current_step": 1, "values": {"offset": 0, "len": 0}}
+    )
+    frame = struct.pack("<II", len(header), 0) + header.encode("utf-8")
+    decoded = framing.read_message(io.BytesIO(frame))
+    assert decoded is not None and list(decoded["values"]) == []
@@ -0,0 +1,112 @@
+import io
+import json
+import os
+from typing import Any
+from typing import Dict
+
+import pytest
+
+from kurobako.solver import SolverRunner
+
+optuna = pytest.importorskip("optuna")
+from kurobako.solver.optuna import OptunaSolverFactory  # NOQA
+
+SPEC = {
+    "name": "quadratic",
+    "attrs": {"version": "1"},
+    "params_domain": [
+        {
+            "name": "x",
+            "range": {"type": "CONTINUOUS", "low": -1.0, "high": 1.0},
+            "distribution": "UNIFORM",
+            "constraint": None,
+        }
+    ],
+    "values_domain": [
+        {
+            "name": "y",
+            "range": {"type": "CONTINUOUS", "low": 0.0, "high": 1.0},
+            "distribution": "UNIFORM",
+            "constraint": None,
+        }
+    ],
+    "steps": [1],
+}
+
+
+def _trial_record(x: float, y: float, end_step: int) -> Dict[str, Any]:
+    return {
+        "thread_id": 0,
+        "params": [x],
+        "evaluations": [{"start_step": 0, "end_step": end_step, "values": [y]}],
+    }
+
+
+def _run_solver(factory: OptunaSolverFactory, seed: int, n_trials: int) -> None:
+    messages = [
+        {"type": "CREATE_SOLVER_CAST", "solver_id": 0, "random_seed": seed, "problem": SPEC}
+    ]
+    for i in range(n_trials):
+        messages.append({"type": "ASK_CALL", "solver_id": 0, "next_trial_id": i})
+        trial = {"id": i, "values": [0.5], "current_step": 1}
+        messages.append({"type": "TELL_CALL", "solver_id": 0, "trial": trial})
+    messages.append({"type": "DROP_SOLVER_CAST", "solver_id": 0})
+
+    stdin = io.BytesIO(b"".join(json.dumps(m).encode("utf-8") + b"\n" for m in messages))
+    SolverRunner(factory, stdin=stdin, stdout=io.BytesIO()).run()
+
+
+def test_result_file_is_matched_by_problem(tmp_path: Any) -> None:
+    # A study record in the layout written by `kurobako run`. The solver seed that kurobako sends
+    # is not the study seed, so the record must match whatever seed the solver gets.
+    other_spec = dict(SPEC, name="other")
+    records = [
+        {
+            "seed": 7,
+            "problem": {"spec": SPEC},
+            "trials": [
+                _trial_record(0.1, 0.01, 1),
+                _trial_record(0.2, 0.04, 1),
+                _trial_record(0.3, 0.09, 0),  # Not evaluated to the last step.
+            ],
+        },
+        {"seed": 7, "problem": {"spec": other_spec}, "trials": [_trial_record(0.9, 0.8, 1)]},
+    ]
+    path = os.path.join(str(tmp_path), "result.json")
+    with open(path, "w") as f:
+        f.write("\n".join(json.dumps(r) for r in records))
+
+    studies = []
+
+    def create_study(seed: int) -> Any:
+        study = optuna.create_study(sampler=optuna.samplers.RandomSampler(seed=seed))
+        studies.append(study)
+        return study
+
+    _run_solver(OptunaSolverFactory(create_study, prior_results=path), 123456, 0)
+
+    (study,) = studies
+    assert sorted(t.params["x"] for t in study.trials) == [0.1, 0.2]
+    assert sorted(t.value for t in study.trials) == [0.01, 0.04]
+
+
+def test_journal_does_not_reimport_prior_trials(tmp_path: Any) -> None:
+    path = os.path.join(str(tmp_path), "journal.log")
+
+    def create_study(seed: int) -> Any:
+        storages = optuna.storages
+        storage = storages.JournalStorage(storages.journal.JournalFileBackend(path))
+        return optuna.create_study(
+            storage=storage, sampler=optuna.samplers.RandomSampler(seed=seed)
+        )
+
+    sizes = []
+    for _ in range(3):
+        _run_solver(OptunaSolverFactory(create_study, prior_results=path), 1, 2)
+
+        storage = optuna.storages.JournalStorage(optuna.storages.journal.JournalFileBackend(path))
+        studies = storage.get_all_studies()
+        sizes.append([len(storage.get_all_trials(s._study_id)) for s in studies])
+
+    # Each study gets the real trials of the earlier studies and two new ones.
+    assert sizes == [[2], [2, 4], [2, 4, 6]]